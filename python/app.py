@@ -1,74 +1,124 @@
 import os
 import io
 import csv
-import sqlite3
-from datetime import datetime
+import gzip
+import html
+import base64
+from collections import namedtuple
+from contextlib import closing
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from flask import Flask, request, redirect, url_for, render_template_string, flash, Response
+from flask import Flask, request, redirect, url_for, render_template_string, flash, Response, stream_with_context
+from db import SQL_COUNT_ALL, SQL_COUNT_UNLABELED, PoolTimeout, borrow, init_schema, open_connection
 
 load_dotenv()
-SQLITE_DB = "weather_drone_data.db"
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
 
+# El anotador no depende de que el logger haya migrado ya la base de datos
+init_schema()
+
 DEFAULT_PAGE_SIZE = 25
+CSV_BATCH_SIZE = 500
+
+# Valores aceptados para la etiqueta rained ("" o None la borran)
+ALLOWED_RAINED_VALUES = frozenset(("0", "1", "", None))
 
 TABLE_COLUMNS = [
     'id', 'timestamp', 'temperature', 'humidity', 'pressure', 'latitude', 'longitude', 'altitude', 'speed', 'hdop', 'satellites', 'time_utc', 'rained', 'rain_checked_at',
     'is_daytime', 'dew_point', 'heat_index', 'wind_chill', 'uv_index', 'precipitation_probability_percent', 'precipitation_probability_type', 'precip_qpf', 'thunderstorm_probability', 'air_pressure_msl', 'wind_direction_degrees', 'wind_direction_cardinal', 'wind_speed', 'wind_gust', 'visibility_distance', 'cloud_cover', 'feels_like_temperature'
 ]
 
+# Columnas que muestra la tabla del anotador (la exportación CSV usa TABLE_COLUMNS)
+INDEX_COLUMNS = [
+    'id', 'timestamp', 'temperature', 'humidity', 'pressure', 'latitude', 'longitude', 'altitude', 'speed', 'satellites', 'time_utc', 'rained',
+    'dew_point', 'heat_index', 'wind_chill', 'uv_index', 'precipitation_probability_percent', 'precipitation_probability_type', 'precip_qpf', 'thunderstorm_probability', 'air_pressure_msl', 'wind_direction_cardinal', 'wind_speed', 'wind_gust', 'cloud_cover'
+]
+
+# Acceso por atributo (slot en C) en lugar de búsqueda por nombre de sqlite3.Row
+Reading = namedtuple('Reading', INDEX_COLUMNS)
+
 BASE_QUERY = f"SELECT {', '.join(TABLE_COLUMNS)} FROM weather_readings"
+INDEX_QUERY = f"SELECT {', '.join(INDEX_COLUMNS)} FROM weather_readings"
 
 
-def get_connection():
-    return sqlite3.connect(SQLITE_DB)
+def _page_query(only_unlabeled: bool, direction: str, with_cursor: bool):
+    conditions = ["rained IS NULL"] if only_unlabeled else []
+    op, order = ('>', 'ASC') if direction == 'prev' else ('<', 'DESC')
+    if with_cursor:
+        conditions.append(f"(timestamp, id) {op} (?, ?)")
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"{INDEX_QUERY}{where} ORDER BY timestamp {order}, id {order} LIMIT ?"
 
 
-def fetch_page(page: int, page_size: int, only_unlabeled: bool = False):
-    offset = (page-1)*page_size
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    where = "WHERE rained IS NULL" if only_unlabeled else ""
-    cur.execute(
-        f"{BASE_QUERY} {where} ORDER BY timestamp DESC LIMIT ? OFFSET ?", (page_size, offset))
-    rows = cur.fetchall()
-    if only_unlabeled:
-        cur.execute(
-            "SELECT COUNT(*) FROM weather_readings WHERE rained IS NULL")
-    else:
-        cur.execute("SELECT COUNT(*) FROM weather_readings")
-    total = cur.fetchone()[0]
-    conn.close()
-    return rows, total
+# Sentencias SQL construidas una sola vez: el texto idéntico permite que el
+# caché de sentencias de cada conexión del pool las reutilice ya compiladas
+SQL_FETCH_PAGE_ALL = {(direction, with_cursor): _page_query(False, direction, with_cursor)
+                      for direction in ('next', 'prev') for with_cursor in (False, True)}
+SQL_FETCH_PAGE_UNLABELED = {(direction, with_cursor): _page_query(True, direction, with_cursor)
+                            for direction in ('next', 'prev') for with_cursor in (False, True)}
+SQL_UPDATE_RAINED_NULL = "UPDATE weather_readings SET rained=NULL, rain_checked_at=NULL WHERE id=?"
+SQL_UPDATE_RAINED_SET = "UPDATE weather_readings SET rained=?, rain_checked_at=? WHERE id=?"
+SQL_EXPORT_CSV = f"{BASE_QUERY} ORDER BY timestamp ASC"
+
+
+def encode_cursor(ts, rec_id):
+    return base64.urlsafe_b64encode(f"{ts}|{rec_id}".encode()).decode()
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        ts, rec_id = base64.urlsafe_b64decode(
+            token.encode()).decode().split('|', 1)
+        return ts, int(rec_id)
+    except ValueError:
+        return None
+
+
+def fetch_page(cursor, direction: str, page_size: int, only_unlabeled: bool = False):
+    # Paginación por cursor (timestamp, id): el coste no depende de la profundidad
+    queries = SQL_FETCH_PAGE_UNLABELED if only_unlabeled else SQL_FETCH_PAGE_ALL
+    sql = queries[direction, cursor is not None]
+    with borrow() as conn:
+        cur = conn.cursor()
+        # Total mantenido por triggers en la tabla counters (sin COUNT(*))
+        cur.execute(SQL_COUNT_UNLABELED if only_unlabeled else SQL_COUNT_ALL)
+        total = cur.fetchone()[0]
+        limit = page_size
+        if direction == 'prev' and cursor is None:
+            # Última página: sólo el resto, para que los límites coincidan
+            # con los de la paginación hacia adelante
+            limit = total % page_size or page_size
+        params = (*cursor, limit + 1) if cursor is not None else (limit + 1,)
+        cur.execute(sql, params)
+        rows = list(map(Reading._make, cur.fetchall()))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+    return rows, total, has_more
 
 
 def update_rained(records):
-    conn = get_connection()
-    cur = conn.cursor()
-    now = datetime.utcnow().isoformat()
-    updated = 0
-    for rec_id, val in records.items():
-        if val not in ("0", "1", "", None):
-            continue
-        if val == "":
-            cur.execute(
-                "UPDATE weather_readings SET rained=NULL, rain_checked_at=NULL WHERE id=?", (rec_id,))
-        else:
-            cur.execute("UPDATE weather_readings SET rained=?, rain_checked_at=? WHERE id=?", (int(
-                val), now, rec_id))
-        updated += 1
-    conn.commit()
-    conn.close()
-    return updated
+    now = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    valid = {rec_id: val for rec_id, val in records.items()
+             if val in ALLOWED_RAINED_VALUES}
+    nulls = [(rec_id,) for rec_id, val in valid.items() if not val]
+    sets = [(int(val), now, rec_id) for rec_id, val in valid.items() if val]
+    with borrow(write=True) as conn:
+        cur = conn.cursor()
+        cur.executemany(SQL_UPDATE_RAINED_NULL, nulls)
+        cur.executemany(SQL_UPDATE_RAINED_SET, sets)
+    return len(nulls) + len(sets)
 
 
 @app.route('/')
 def index():
     try:
-        page = int(request.args.get('page', '1'))
+        page = max(int(request.args.get('page', '1')), 1)
     except ValueError:
         page = 1
     try:
@@ -76,16 +126,57 @@ def index():
     except ValueError:
         page_size = DEFAULT_PAGE_SIZE
     only_unlabeled = request.args.get('filter') == 'unlabeled'
-    rows, total = fetch_page(page, page_size, only_unlabeled)
+    cursor = decode_cursor(request.args.get('cursor'))
+    direction = 'prev' if request.args.get('dir') == 'prev' else 'next'
+    rows, total, has_more = fetch_page(
+        cursor, direction, page_size, only_unlabeled)
+    if direction == 'prev':
+        has_prev, has_next = has_more, cursor is not None
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    prev_cursor = encode_cursor(
+        rows[0].timestamp, rows[0].id) if rows and has_prev else None
+    next_cursor = encode_cursor(
+        rows[-1].timestamp, rows[-1].id) if rows and has_next else None
     total_pages = (total + page_size - 1)//page_size
-    return render_template_string(TEMPLATE_INDEX,
-                                  rows=rows,
-                                  page=page,
-                                  page_size=page_size,
-                                  total=total,
-                                  total_pages=total_pages,
-                                  only_unlabeled=only_unlabeled
-                                  )
+    filter_arg = 'unlabeled' if only_unlabeled else None
+    # Navegación acotada: primera / anterior / siguiente / última. La última
+    # página se obtiene recorriendo el índice en orden inverso, sin cursor
+    first_url = prev_url = next_url = last_url = None
+    if prev_cursor:
+        first_url = url_for('index', page=1, page_size=page_size,
+                            filter=filter_arg)
+        prev_url = url_for('index', cursor=prev_cursor, dir='prev', page=page-1,
+                           page_size=page_size, filter=filter_arg)
+    if next_cursor:
+        next_url = url_for('index', cursor=next_cursor, page=page+1,
+                           page_size=page_size, filter=filter_arg)
+        last_url = url_for('index', dir='prev', page=total_pages,
+                           page_size=page_size, filter=filter_arg)
+    # Los mensajes flash se consumen antes de empezar a transmitir la respuesta
+    flashes = render_template_string(TEMPLATE_FLASH)
+    controls = render_controls(page_size, only_unlabeled)
+    nav = render_nav(page, first_url, prev_url, next_url, last_url)
+    # Las filas se renderizan antes de enviar el estado HTTP: un error aquí
+    # produce un 500 en lugar de una página 200 cortada a mitad de tabla
+    table_rows = ''.join(map(render_row, rows))
+
+    def generate():
+        yield HTML_HEAD
+        yield flashes
+        yield controls
+        yield HTML_TABLE_HEAD.format(update_url=url_for('update'))
+        yield table_rows
+        yield HTML_TABLE_TAIL
+        yield nav
+        yield f"\t<p>Total registros: {total} | Página {page} de {total_pages}</p>\n"
+        yield HTML_TAIL
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return Response("Base de datos ocupada, intenta de nuevo en unos segundos", status=503, mimetype='text/plain')
 
 
 @app.route('/update', methods=['POST'])
@@ -102,23 +193,134 @@ def update():
 
 @app.route('/export.csv')
 def export_csv():
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute(f"{BASE_QUERY} ORDER BY timestamp ASC")
-    rows = cur.fetchall()
-    conn.close()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(TABLE_COLUMNS)
-    for r in rows:
-        writer.writerow([r[c] for c in TABLE_COLUMNS])
-    csv_data = output.getvalue()
-    output.close()
-    return Response(csv_data, mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename=weather_dataset.csv'})
-
-
-TEMPLATE_INDEX = """
+    def generate():
+        # Conexión propia: la duración de la descarga la controla el cliente y
+        # no debe retener un lector del pool
+        conn = open_connection()
+        try:
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(TABLE_COLUMNS)
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            # El cursor se recorre por lotes, sin cargar la tabla completa en memoria
+            cur = conn.execute(SQL_EXPORT_CSV)
+            while True:
+                batch = cur.fetchmany(CSV_BATCH_SIZE)
+                if not batch:
+                    break
+                writer.writerows(batch)
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
+        finally:
+            conn.close()
+    headers = {'Content-Disposition': 'attachment; filename=weather_dataset.csv',
+               'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip'] > 0:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(gzip_stream(generate()), mimetype='text/csv', headers=headers)
+    return Response(generate(), mimetype='text/csv', headers=headers)
+
+
+def gzip_stream(chunks):
+    # Comprime al vuelo los fragmentos de texto; compresslevel=1 mantiene baja
+    # la latencia del streaming con un coste de CPU mínimo
+    buffer = io.BytesIO()
+    with closing(chunks), gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=1) as gz:
+        for chunk in chunks:
+            gz.write(chunk.encode())
+            if buffer.tell():
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def _e(value):
+    # Las columnas REAL/INTEGER de SQLite pueden guardar texto arbitrario,
+    # así que toda celda se escapa como hacía el autoescape de Jinja
+    return html.escape(str(value))
+
+
+def _coord(value):
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)):
+        return '%0.5f' % value
+    return _e(value)
+
+
+def _selected(flag):
+    return ' selected' if flag else ''
+
+
+def render_row(r):
+    rained = r.rained
+    return (
+        f"<tr><td>{_e(r.id)}</td><td>{_e(r.timestamp)}</td>"
+        f"<td>{_e(r.temperature)}</td><td>{_e(r.humidity)}</td><td>{_e(r.pressure)}</td>"
+        f"<td>{_coord(r.latitude)}</td><td>{_coord(r.longitude)}</td>"
+        f"<td>{_e(r.altitude)}</td><td>{_e(r.speed)}</td><td>{_e(r.satellites)}</td>"
+        f"<td>{_e(r.time_utc)}</td>"
+        f"<td><select name='rained_{_e(r.id)}' class='rained-select'>"
+        f"<option value=''{_selected(rained is None)}>?</option>"
+        f"<option value='1'{_selected(rained == 1)}>Sí</option>"
+        f"<option value='0'{_selected(rained == 0)}>No</option>"
+        f"</select></td>"
+        f"<td>{_e(r.dew_point)}</td><td>{_e(r.heat_index)}</td><td>{_e(r.wind_chill)}</td>"
+        f"<td>{_e(r.uv_index)}</td><td>{_e(r.precipitation_probability_percent)}</td>"
+        f"<td>{_e(r.precipitation_probability_type)}</td><td>{_e(r.precip_qpf)}</td>"
+        f"<td>{_e(r.thunderstorm_probability)}</td><td>{_e(r.air_pressure_msl)}</td>"
+        f"<td>{_e(r.wind_direction_cardinal)}</td><td>{_e(r.wind_speed)}</td>"
+        f"<td>{_e(r.wind_gust)}</td><td>{_e(r.cloud_cover)}</td></tr>\n"
+    )
+
+
+def render_controls(page_size, only_unlabeled):
+    if only_unlabeled:
+        toggle = "<button type='submit'>Mostrar todos</button>"
+    else:
+        toggle = ("<input type='hidden' name='filter' value='unlabeled'>"
+                  "<button type='submit'>Mostrar sólo sin etiqueta</button>")
+    return f"""	<div class='controls'>
+		<form method='get'>
+			<input type='hidden' name='filter' value='{'unlabeled' if only_unlabeled else ''}'>
+			<label>Tamaño: <input type='number' name='page_size' value='{page_size}' min='5'></label>
+			<button type='submit'>Ir</button>
+		</form>
+		<form method='get'>
+			{toggle}
+		</form>
+		<a href='{url_for('export_csv')}'>Exportar CSV</a>
+	</div>
+"""
+
+
+def render_nav(page, first_url, prev_url, next_url, last_url):
+    links = []
+    if first_url:
+        links.append(f"<a href='{_e(first_url)}'>&laquo; Primera</a>")
+    if prev_url:
+        links.append(f"<a href='{_e(prev_url)}'>&lsaquo; Anterior</a>")
+    links.append(f"<span><strong>{page}</strong></span>")
+    if next_url:
+        links.append(f"<a href='{_e(next_url)}'>Siguiente &rsaquo;</a>")
+    if last_url:
+        links.append(f"<a href='{_e(last_url)}'>Última &raquo;</a>")
+    return f"\t<nav>\n\t\t{' '.join(links)}\n\t</nav>\n"
+
+
+TEMPLATE_FLASH = """
+	{% with messages = get_flashed_messages() %}
+		{% if messages %}
+			{% for m in messages %}<div class="flash">{{m}}</div>{% endfor %}
+		{% endif %}
+	{% endwith %}
+"""
+
+HTML_HEAD = """
 <!DOCTYPE html>
 <html lang='es'>
 <head>
@@ -138,29 +340,9 @@ TEMPLATE_INDEX = """
 </head>
 <body>
 	<h1>Weather Drone Dataset Annotator</h1>
-	{% with messages = get_flashed_messages() %}
-		{% if messages %}
-			{% for m in messages %}<div class="flash">{{m}}</div>{% endfor %}
-		{% endif %}
-	{% endwith %}
-	<div class='controls'>
-		<form method='get'>
-			<input type='hidden' name='filter' value='{{ 'unlabeled' if only_unlabeled else '' }}'>
-			<label>Página: <input type='number' name='page' value='{{page}}' min='1'></label>
-			<label>Tamaño: <input type='number' name='page_size' value='{{page_size}}' min='5'></label>
-			<button type='submit'>Ir</button>
-		</form>
-		<form method='get'>
-			{% if not only_unlabeled %}
-				<input type='hidden' name='filter' value='unlabeled'>
-				<button type='submit'>Mostrar sólo sin etiqueta</button>
-			{% else %}
-				<button type='submit'>Mostrar todos</button>
-			{% endif %}
-		</form>
-		<a href='{{ url_for('export_csv') }}'>Exportar CSV</a>
-	</div>
-	<form method='post' action='{{ url_for('update') }}'>
+"""
+
+HTML_TABLE_HEAD = """	<form method='post' action='{update_url}'>
 		<table>
 			<thead>
 				<tr>
@@ -192,52 +374,15 @@ TEMPLATE_INDEX = """
 				</tr>
 			</thead>
 			<tbody>
-				{% for r in rows %}
-				<tr>
-					<td>{{r['id']}}</td>
-					<td>{{r['timestamp']}}</td>
-					<td>{{r['temperature']}}</td>
-					<td>{{r['humidity']}}</td>
-					<td>{{r['pressure']}}</td>
-					<td>{{'%0.5f' % r['latitude'] if r['latitude'] is not none else ''}}</td>
-					<td>{{'%0.5f' % r['longitude'] if r['longitude'] is not none else ''}}</td>
-					<td>{{r['altitude']}}</td>
-					<td>{{r['speed']}}</td>
-					<td>{{r['satellites']}}</td>
-					<td>{{r['time_utc']}}</td>
-					<td>
-						<select name='rained_{{r['id']}}' class='rained-select'>
-							<option value='' {% if r['rained'] is none %}selected{% endif %}>?</option>
-							<option value='1' {% if r['rained'] == 1 %}selected{% endif %}>Sí</option>
-							<option value='0' {% if r['rained'] == 0 %}selected{% endif %}>No</option>
-						</select>
-					</td>
-					<td>{{r['dew_point']}}</td>
-					<td>{{r['heat_index']}}</td>
-					<td>{{r['wind_chill']}}</td>
-					<td>{{r['uv_index']}}</td>
-					<td>{{r['precipitation_probability_percent']}}</td>
-					<td>{{r['precipitation_probability_type']}}</td>
-					<td>{{r['precip_qpf']}}</td>
-					<td>{{r['thunderstorm_probability']}}</td>
-					<td>{{r['air_pressure_msl']}}</td>
-					<td>{{r['wind_direction_cardinal']}}</td>
-					<td>{{r['wind_speed']}}</td>
-					<td>{{r['wind_gust']}}</td>
-					<td>{{r['cloud_cover']}}</td>
-				</tr>
-				{% endfor %}
-			</tbody>
+"""
+
+HTML_TABLE_TAIL = """			</tbody>
 		</table>
 		<p><button type='submit'>Guardar cambios</button></p>
 	</form>
-	<nav>
-		{% for p in range(1, total_pages+1) %}
-			{% if p == page %}<span><strong>{{p}}</strong></span>{% else %}<a href='?page={{p}}&page_size={{page_size}}{% if only_unlabeled %}&filter=unlabeled{% endif %}'>{{p}}</a>{% endif %}
-		{% endfor %}
-	</nav>
-	<p>Total registros: {{total}} | Página {{page}} de {{total_pages}}</p>
-</body>
+"""
+
+HTML_TAIL = """</body>
 </html>
 """
 
@@ -0,0 +1,277 @@
+"""
+Pool de conexiones SQLite y esquema compartidos por el logger y el anotador web.
+
+Las conexiones se abren una sola vez y se reutilizan: un escritor único
+protegido por un lock y varios lectores en una cola.
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+SQLITE_DB = "weather_drone_data.db"
+
+# Número de conexiones de sólo lectura del pool
+READER_CONNECTIONS = 4
+# Segundos de espera máxima por un lector libre antes de rendirse
+READER_TIMEOUT = 5
+
+# Tamaño del caché de sentencias preparadas de cada conexión
+CACHED_STATEMENTS = 256
+
+# Columnas de la Weather API (se agregan a tablas existentes si faltan)
+WEATHER_COLUMNS = {
+    'is_daytime': 'INTEGER',
+    'dew_point': 'REAL',
+    'heat_index': 'REAL',
+    'wind_chill': 'REAL',
+    'uv_index': 'INTEGER',
+    'precipitation_probability_percent': 'INTEGER',
+    'precipitation_probability_type': 'TEXT',
+    'precip_qpf': 'REAL',
+    'thunderstorm_probability': 'INTEGER',
+    'air_pressure_msl': 'REAL',
+    'wind_direction_degrees': 'INTEGER',
+    'wind_direction_cardinal': 'TEXT',
+    'wind_speed': 'REAL',
+    'wind_gust': 'REAL',
+    'visibility_distance': 'REAL',
+    'cloud_cover': 'REAL',
+    'feels_like_temperature': 'REAL'
+}
+
+# Columnas de cada lectura: orden del INSERT y columnas copiadas a last_reading
+READING_COLUMNS = [
+    'temperature', 'humidity', 'pressure', 'latitude', 'longitude',
+    'altitude', 'speed', 'hdop', 'satellites', 'time_utc', 'rained', 'rain_checked_at',
+    *WEATHER_COLUMNS
+]
+
+# PRAGMAs aplicados a cada conexión al abrirla
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+
+class PoolTimeout(Exception):
+    """No hubo una conexión de lectura libre dentro de READER_TIMEOUT."""
+
+
+def open_connection(path: str = SQLITE_DB):
+    """Abre una conexión configurada fuera del pool (p. ej. para transmisiones largas)."""
+    # Sin detección de tipos y en modo autocommit: las transacciones de
+    # escritura se abren explícitamente en borrow(write=True)
+    conn = sqlite3.connect(
+        path, check_same_thread=False, cached_statements=CACHED_STATEMENTS,
+        detect_types=0, isolation_level=None)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Un escritor (serializado con un lock) y N lectores reutilizables."""
+
+    def __init__(self, path: str, readers: int = READER_CONNECTIONS):
+        self.path = path
+        self._readers = queue.Queue(maxsize=readers)
+        for _ in range(readers):
+            self._readers.put(self._open())
+        self._writer = self._open()
+        self._write_lock = threading.Lock()
+
+    def _open(self):
+        return open_connection(self.path)
+
+    @contextmanager
+    def borrow(self, write: bool = False):
+        if write:
+            with self._write_lock:
+                self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._writer
+                    self._writer.execute("COMMIT")
+                except BaseException:
+                    self._writer.execute("ROLLBACK")
+                    raise
+        else:
+            try:
+                conn = self._readers.get(timeout=READER_TIMEOUT)
+            except queue.Empty:
+                raise PoolTimeout(
+                    f"Sin conexiones de lectura libres tras {READER_TIMEOUT}s") from None
+            try:
+                yield conn
+            finally:
+                self._readers.put(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Devuelve el pool del proceso, creándolo en el primer uso."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(SQLITE_DB)
+    return _pool
+
+
+@contextmanager
+def borrow(write: bool = False):
+    """Presta una conexión del pool; con write=True, la del escritor dentro de una transacción BEGIN IMMEDIATE."""
+    with get_pool().borrow(write) as conn:
+        yield conn
+
+
+# Lecturas O(1) de la tabla counters mantenida por los triggers de init_schema
+SQL_COUNT_ALL = "SELECT value FROM counters WHERE name = 'all'"
+SQL_COUNT_UNLABELED = "SELECT value FROM counters WHERE name = 'unlabeled'"
+
+
+def init_schema():
+    """Crea las tablas, índices, triggers y contadores si faltan (migración suave).
+
+    La llaman tanto el logger como el anotador web al arrancar, así que
+    cualquiera de los dos procesos deja la base de datos lista para el otro.
+    """
+    with borrow(write=True) as conn:
+        cursor = conn.cursor()
+
+        # Crear tabla para los registros
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS weather_readings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                temperature REAL,
+                humidity REAL,
+                pressure REAL,
+                latitude REAL,
+                longitude REAL,
+                altitude REAL,
+                speed REAL,
+                hdop REAL,
+                satellites INTEGER,
+                time_utc TEXT,
+                rained INTEGER,
+                rain_checked_at DATETIME
+            )
+        """)
+
+        # Crear tabla para el último registro procesado
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS last_reading (
+                id INTEGER PRIMARY KEY,
+                temperature REAL,
+                humidity REAL,
+                pressure REAL,
+                latitude REAL,
+                longitude REAL,
+                altitude REAL,
+                speed REAL,
+                hdop REAL,
+                satellites INTEGER,
+                time_utc TEXT,
+                rained INTEGER,
+                rain_checked_at DATETIME,
+                last_update DATETIME
+            )
+        """)
+
+        # Insertar fila inicial si no existe
+        cursor.execute("SELECT COUNT(*) FROM last_reading")
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO last_reading (id) VALUES (1)")
+
+        # Asegurar columnas de Weather API (migración suave)
+        def ensure_columns(table: str, columns: Dict[str, str]):
+            cursor.execute(f"PRAGMA table_info({table})")
+            existing = {row[1] for row in cursor.fetchall()}
+            for col, col_type in columns.items():
+                if col not in existing:
+                    try:
+                        cursor.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
+                    except Exception as e:
+                        print(
+                            f"⚠️  No se pudo agregar columna '{col}' en '{table}': {e}")
+
+        ensure_columns('weather_readings', WEATHER_COLUMNS)
+        ensure_columns('last_reading', WEATHER_COLUMNS)
+
+        # Índice para la paginación por cursor (timestamp, id) del anotador
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_wr_ts_id ON weather_readings(timestamp DESC, id DESC)")
+        # Índice parcial para el filtro de registros sin etiquetar: sólo contiene
+        # las filas con rained IS NULL, así que se reduce a medida que se etiquetan
+        cursor.execute("DROP INDEX IF EXISTS idx_wr_rained_ts")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_wr_unlabeled ON weather_readings(timestamp DESC, id DESC) WHERE rained IS NULL")
+
+        # Mantener last_reading sincronizado con cada nuevo registro. El trigger
+        # se recrea siempre para incluir columnas agregadas por ensure_columns
+        sync_columns = ", ".join(f"{col} = NEW.{col}" for col in READING_COLUMNS)
+        cursor.execute("DROP TRIGGER IF EXISTS trg_sync_last_reading")
+        cursor.execute(f"""
+            CREATE TRIGGER trg_sync_last_reading
+            AFTER INSERT ON weather_readings
+            BEGIN
+                UPDATE last_reading
+                    SET {sync_columns}, last_update = CURRENT_TIMESTAMP
+                    WHERE id = 1;
+            END
+        """)
+
+        # Contadores mantenidos por triggers: el total de registros (y de
+        # registros sin etiquetar) se lee en O(1) en lugar de con COUNT(*)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("""
+            INSERT OR IGNORE INTO counters (name, value)
+            SELECT 'all', COUNT(*) FROM weather_readings
+        """)
+        cursor.execute("""
+            INSERT OR IGNORE INTO counters (name, value)
+            SELECT 'unlabeled', COUNT(*) FROM weather_readings WHERE rained IS NULL
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_counters_insert
+            AFTER INSERT ON weather_readings
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'all';
+                UPDATE counters SET value = value + 1
+                    WHERE name = 'unlabeled' AND NEW.rained IS NULL;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_counters_delete
+            AFTER DELETE ON weather_readings
+            BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'all';
+                UPDATE counters SET value = value - 1
+                    WHERE name = 'unlabeled' AND OLD.rained IS NULL;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_counters_rained
+            AFTER UPDATE OF rained ON weather_readings
+            BEGIN
+                UPDATE counters
+                    SET value = value + (NEW.rained IS NULL) - (OLD.rained IS NULL)
+                    WHERE name = 'unlabeled';
+            END
+        """)
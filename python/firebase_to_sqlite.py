@@ -7,12 +7,17 @@ predicción de lluvia.
 Guarda sólo registros nuevos (según cambios en sensores o probabilidad de precipitación).
 """
 import os
+import math
+import operator
 import sqlite3
 import requests
 import time
-from datetime import datetime
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any
+from db import SQLITE_DB, READING_COLUMNS, SQL_COUNT_ALL, borrow, init_schema
 
 load_dotenv()
 
@@ -30,9 +35,6 @@ FIREBASE_USER_PASSWORD = os.getenv("FIREBASE_USER_PASSWORD")
 _id_token = None
 _token_expiry = 0
 
-# Configuración de SQLite
-SQLITE_DB = "weather_drone_data.db"
-
 # Intervalo de consulta (en segundos)
 QUERY_INTERVAL = 60  # Ajustar según necesidad
 
@@ -40,27 +42,52 @@ QUERY_INTERVAL = 60  # Ajustar según necesidad
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 WEATHER_UNITS_SYSTEM = "METRIC"  # METRIC | IMPERIAL
 WEATHER_API_ENABLED = True  # Permitir desactivar rápidamente
+# Distancia (en metros) a partir de la cual se vuelve a consultar la Weather API
+WEATHER_REFETCH_DISTANCE_M = 100
+# Caché de la Weather API por coordenadas redondeadas (3 decimales ≈ 110 m)
+WEATHER_CACHE_TTL = 300  # segundos
+WEATHER_CACHE_DECIMALS = 3
+_weather_cache = {}
+
+# Sesión HTTP compartida: reutiliza conexiones TLS (keep-alive) entre consultas
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.3,
+                      status_forcelist=[502, 503, 504], raise_on_status=False)
+))
+
+
+# Fila vacía y extractor en C de los valores en el orden de READING_COLUMNS
+_EMPTY_READING = dict.fromkeys(READING_COLUMNS)
+_pack_reading = operator.itemgetter(*READING_COLUMNS)
+
+
+# Tolerancia para comparar valores float con el último registro
+READING_TOLERANCE = 0.001
+
+# Sentencias SQL del bucle principal, definidas una sola vez para que el
+# caché de sentencias de la conexión las reutilice ya compiladas
+
+# Devuelve una fila si los datos coinciden con el último registro guardado
+SQL_SAME_AS_LAST_READING = f"""
+    SELECT 1 FROM last_reading
+    WHERE id = 1
+        AND temperature IS NOT NULL
+        AND ABS(IFNULL(temperature, 0) - ?) <= {READING_TOLERANCE}
+        AND ABS(IFNULL(humidity, 0) - ?) <= {READING_TOLERANCE}
+        AND ABS(IFNULL(pressure, 0) - ?) <= {READING_TOLERANCE}
+        AND ABS(IFNULL(latitude, 0) - ?) <= {READING_TOLERANCE}
+        AND ABS(IFNULL(longitude, 0) - ?) <= {READING_TOLERANCE}
+        AND time_utc IS ?
+        AND (? IS NULL OR precipitation_probability_percent IS NULL
+             OR precipitation_probability_percent = ?)
+"""
 
-
-WEATHER_COLUMNS = {
-    'is_daytime': 'INTEGER',
-    'dew_point': 'REAL',
-    'heat_index': 'REAL',
-    'wind_chill': 'REAL',
-    'uv_index': 'INTEGER',
-    'precipitation_probability_percent': 'INTEGER',
-    'precipitation_probability_type': 'TEXT',
-    'precip_qpf': 'REAL',
-    'thunderstorm_probability': 'INTEGER',
-    'air_pressure_msl': 'REAL',
-    'wind_direction_degrees': 'INTEGER',
-    'wind_direction_cardinal': 'TEXT',
-    'wind_speed': 'REAL',
-    'wind_gust': 'REAL',
-    'visibility_distance': 'REAL',
-    'cloud_cover': 'REAL',
-    'feels_like_temperature': 'REAL'
-}
+SQL_INSERT_READING = f"""
+    INSERT INTO weather_readings ({', '.join(READING_COLUMNS)})
+    VALUES ({', '.join('?' * len(READING_COLUMNS))})
+"""
 
 
 def get_firebase_auth_token():
@@ -85,7 +112,7 @@ def get_firebase_auth_token():
             "returnSecureToken": True
         }
 
-        response = requests.post(auth_url, json=payload, timeout=10)
+        response = _SESSION.post(auth_url, json=payload, timeout=10)
 
         if response.status_code == 200:
             data = response.json()
@@ -107,72 +134,7 @@ def get_firebase_auth_token():
 
 def init_database():
     """Inicializa la base de datos SQLite con las tablas necesarias y agrega columnas nuevas si faltan."""
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-
-    # Crear tabla para los registros
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS weather_readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            temperature REAL,
-            humidity REAL,
-            pressure REAL,
-            latitude REAL,
-            longitude REAL,
-            altitude REAL,
-            speed REAL,
-            hdop REAL,
-            satellites INTEGER,
-            time_utc TEXT,
-            rained INTEGER,
-            rain_checked_at DATETIME
-        )
-    """)
-
-    # Crear tabla para el último registro procesado
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS last_reading (
-            id INTEGER PRIMARY KEY,
-            temperature REAL,
-            humidity REAL,
-            pressure REAL,
-            latitude REAL,
-            longitude REAL,
-            altitude REAL,
-            speed REAL,
-            hdop REAL,
-            satellites INTEGER,
-            time_utc TEXT,
-            rained INTEGER,
-            rain_checked_at DATETIME,
-            last_update DATETIME
-        )
-    """)
-
-    # Insertar fila inicial si no existe
-    cursor.execute("SELECT COUNT(*) FROM last_reading")
-    if cursor.fetchone()[0] == 0:
-        cursor.execute("INSERT INTO last_reading (id) VALUES (1)")
-
-    # Asegurar columnas de Weather API (migración suave)
-    def ensure_columns(table: str, columns: Dict[str, str]):
-        cursor.execute(f"PRAGMA table_info({table})")
-        existing = {row[1] for row in cursor.fetchall()}
-        for col, col_type in columns.items():
-            if col not in existing:
-                try:
-                    cursor.execute(
-                        f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
-                except Exception as e:
-                    print(
-                        f"⚠️  No se pudo agregar columna '{col}' en '{table}': {e}")
-
-    ensure_columns('weather_readings', WEATHER_COLUMNS)
-    ensure_columns('last_reading', WEATHER_COLUMNS)
-
-    conn.commit()
-    conn.close()
+    init_schema()
     print(f"✅ Base de datos '{SQLITE_DB}' inicializada correctamente")
 
 
@@ -187,7 +149,7 @@ def get_firebase_data():
 
         # Agregar el token de autenticación a la URL
         url = f"{FIREBASE_URL}/{DATABASE_PATH}.json?auth={auth_token}"
-        response = requests.get(url, timeout=10)
+        response = _SESSION.get(url, timeout=10)
 
         if response.status_code == 200:
             data = response.json()
@@ -212,88 +174,29 @@ def get_firebase_data():
         return None
 
 
-def get_last_reading():
-    """Obtiene el último registro guardado en SQLite incluyendo columnas meteorológicas externas."""
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT 
-            temperature, humidity, pressure, latitude, longitude,
-            altitude, speed, hdop, satellites, time_utc, rained, rain_checked_at,
-            is_daytime, dew_point, heat_index, wind_chill, uv_index,
-            precipitation_probability_percent, precipitation_probability_type,
-            precip_qpf, thunderstorm_probability, air_pressure_msl,
-            wind_direction_degrees, wind_direction_cardinal, wind_speed,
-            wind_gust, visibility_distance, cloud_cover, feels_like_temperature
-        FROM last_reading WHERE id = 1
-    """)
-
-    result = cursor.fetchone()
-    conn.close()
-
-    if result and result[0] is not None:
-        keys = [
-            'temperature', 'humidity', 'pressure', 'latitude', 'longitude',
-            'altitude', 'speed', 'hdop', 'satellites', 'time_utc', 'rained', 'rain_checked_at',
-            'is_daytime', 'dew_point', 'heat_index', 'wind_chill', 'uv_index',
-            'precipitation_probability_percent', 'precipitation_probability_type',
-            'precip_qpf', 'thunderstorm_probability', 'air_pressure_msl',
-            'wind_direction_degrees', 'wind_direction_cardinal', 'wind_speed',
-            'wind_gust', 'visibility_distance', 'cloud_cover', 'feels_like_temperature'
-        ]
-        return dict(zip(keys, result))
-    return None
-
-
-def is_new_reading(firebase_data, last_reading):
+def is_new_reading(firebase_data):
     """Verifica si los datos son nuevos comparando con el último registro.
 
     Criterios:
     - Cambios en sensores base (temp/hum/pres o posición)
     - Cambio en timestamp timeUTC
     - Cambio en probabilidad de precipitación externa (si disponible)
-    """
-    if last_reading is None:
-        return True
-
-    # Comparar los valores clave para determinar si es un registro nuevo
-    # Usamos tolerancia para valores float por precisión
-    tolerance = 0.001
 
+    La comparación se hace dentro de SQLite contra la fila de last_reading.
+    """
+    precip_prob = firebase_data.get('precipitation_probability_percent')
     try:
-        # Comparar valores del BME280
-        temp_diff = abs(firebase_data.get('temperature', 0) -
-                        last_reading.get('temperature', 0))
-        hum_diff = abs(firebase_data.get('humidity', 0) -
-                       last_reading.get('humidity', 0))
-        pres_diff = abs(firebase_data.get('pressure', 0) -
-                        last_reading.get('pressure', 0))
-
-        # Comparar valores GPS (si existen)
-        lat_diff = abs(firebase_data.get('latitude', 0) -
-                       last_reading.get('latitude', 0))
-        lng_diff = abs(firebase_data.get('longitude', 0) -
-                       last_reading.get('longitude', 0))
-
-        # Si algún valor cambió significativamente, es un nuevo registro
-        if (temp_diff > tolerance or hum_diff > tolerance or pres_diff > tolerance or
-                lat_diff > tolerance or lng_diff > tolerance):
-            return True
-
-        # Comparar el timestamp UTC si existe
-        if firebase_data.get('timeUTC') != last_reading.get('time_utc'):
-            return True
-
-        # Verificar cambio en probabilidad de precipitación (Weather API)
-        new_precip_prob = firebase_data.get(
-            'precipitation_probability_percent')
-        old_precip_prob = last_reading.get('precipitation_probability_percent')
-        if new_precip_prob is not None and old_precip_prob is not None:
-            if new_precip_prob != old_precip_prob:
-                return True
-
-        return False
+        with borrow() as conn:
+            same = conn.execute(SQL_SAME_AS_LAST_READING, (
+                firebase_data.get('temperature', 0),
+                firebase_data.get('humidity', 0),
+                firebase_data.get('pressure', 0),
+                firebase_data.get('latitude', 0),
+                firebase_data.get('longitude', 0),
+                firebase_data.get('timeUTC'),
+                precip_prob, precip_prob
+            )).fetchone()
+        return same is None
     except Exception as e:
         print(f"⚠️  Error al comparar datos: {e}")
         return True  # En caso de error, considerarlo nuevo
@@ -301,86 +204,16 @@ def is_new_reading(firebase_data, last_reading):
 
 def save_to_sqlite(data):
     """Guarda los datos en SQLite (sensores + Weather API)."""
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-
+    # Normalizar claves de Firebase una sola vez (timeUTC -> time_utc)
+    row = {**_EMPTY_READING, **data, 'time_utc': data.get('timeUTC')}
     try:
-        # Insertar nuevo registro
-        cursor.execute("""
-            INSERT INTO weather_readings (
-                temperature, humidity, pressure, latitude, longitude, altitude,
-                speed, hdop, satellites, time_utc, rained, rain_checked_at,
-                is_daytime, dew_point, heat_index, wind_chill, uv_index,
-                precipitation_probability_percent, precipitation_probability_type,
-                precip_qpf, thunderstorm_probability, air_pressure_msl,
-                wind_direction_degrees, wind_direction_cardinal, wind_speed,
-                wind_gust, visibility_distance, cloud_cover, feels_like_temperature
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (
-            data.get('temperature'),
-            data.get('humidity'),
-            data.get('pressure'),
-            data.get('latitude'),
-            data.get('longitude'),
-            data.get('altitude'),
-            data.get('speed'),
-            data.get('hdop'),
-            data.get('satellites'),
-            data.get('timeUTC'),
-            data.get('rained'),
-            data.get('rain_checked_at'),
-            data.get('is_daytime'),
-            data.get('dew_point'),
-            data.get('heat_index'),
-            data.get('wind_chill'),
-            data.get('uv_index'),
-            data.get('precipitation_probability_percent'),
-            data.get('precipitation_probability_type'),
-            data.get('precip_qpf'),
-            data.get('thunderstorm_probability'),
-            data.get('air_pressure_msl'),
-            data.get('wind_direction_degrees'),
-            data.get('wind_direction_cardinal'),
-            data.get('wind_speed'),
-            data.get('wind_gust'),
-            data.get('visibility_distance'),
-            data.get('cloud_cover'),
-            data.get('feels_like_temperature')
-        ))
-
-        # Actualizar el último registro
-        cursor.execute("""
-            UPDATE last_reading SET
-                temperature = ?, humidity = ?, pressure = ?, latitude = ?, longitude = ?,
-                altitude = ?, speed = ?, hdop = ?, satellites = ?, time_utc = ?,
-                rained = ?, rain_checked_at = ?, last_update = ?,
-                is_daytime = ?, dew_point = ?, heat_index = ?, wind_chill = ?, uv_index = ?,
-                precipitation_probability_percent = ?, precipitation_probability_type = ?,
-                precip_qpf = ?, thunderstorm_probability = ?, air_pressure_msl = ?,
-                wind_direction_degrees = ?, wind_direction_cardinal = ?, wind_speed = ?,
-                wind_gust = ?, visibility_distance = ?, cloud_cover = ?, feels_like_temperature = ?
-            WHERE id = 1
-        """, (
-            data.get('temperature'), data.get(
-                'humidity'), data.get('pressure'),
-            data.get('latitude'), data.get('longitude'), data.get('altitude'),
-            data.get('speed'), data.get('hdop'), data.get(
-                'satellites'), data.get('timeUTC'),
-            data.get('rained'), data.get(
-                'rain_checked_at'), datetime.now().isoformat(),
-            data.get('is_daytime'), data.get('dew_point'), data.get(
-                'heat_index'), data.get('wind_chill'), data.get('uv_index'),
-            data.get('precipitation_probability_percent'), data.get(
-                'precipitation_probability_type'),
-            data.get('precip_qpf'), data.get(
-                'thunderstorm_probability'), data.get('air_pressure_msl'),
-            data.get('wind_direction_degrees'), data.get(
-                'wind_direction_cardinal'), data.get('wind_speed'),
-            data.get('wind_gust'), data.get('visibility_distance'), data.get(
-                'cloud_cover'), data.get('feels_like_temperature')
-        ))
-
-        conn.commit()
+        with borrow(write=True) as conn:
+            cursor = conn.cursor()
+
+            # Insertar nuevo registro
+            cursor.execute(SQL_INSERT_READING, _pack_reading(row))
+            # last_reading se actualiza con el trigger trg_sync_last_reading
+
         print(
             f"✅ Nuevo registro guardado - Temp: {data.get('temperature')}°C, Hum: {data.get('humidity')}%, Pres: {data.get('pressure')} hPa")
         if data.get('precipitation_probability_percent') is not None:
@@ -403,8 +236,6 @@ def save_to_sqlite(data):
         print("Registro duplicado ignorado")
     except Exception as e:
         print(f"❌ Error al guardar: {e}")
-    finally:
-        conn.close()
 
 
 def get_weather_api_data(lat: Optional[float], lng: Optional[float]) -> Optional[Dict[str, Any]]:
@@ -419,11 +250,18 @@ def get_weather_api_data(lat: Optional[float], lng: Optional[float]) -> Optional
         return None
     if lat is None or lng is None:
         return None
+    # Reutilizar la respuesta reciente si el dron sigue en la misma zona
+    cache_key = (round(lat, WEATHER_CACHE_DECIMALS),
+                 round(lng, WEATHER_CACHE_DECIMALS))
+    now = time.time()
+    cached = _weather_cache.get(cache_key)
+    if cached and now - cached[0] < WEATHER_CACHE_TTL:
+        return cached[1]
     url = (
         f"https://weather.googleapis.com/v1/currentConditions:lookup?key={WEATHER_API_KEY}&location.latitude={lat}&location.longitude={lng}&unitsSystem={WEATHER_UNITS_SYSTEM}"
     )
     try:
-        resp = requests.get(url, timeout=10)
+        resp = _SESSION.get(url, timeout=10)
         if resp.status_code != 200:
             print(f"⚠️  Weather API status {resp.status_code}")
             return None
@@ -447,20 +285,38 @@ def get_weather_api_data(lat: Optional[float], lng: Optional[float]) -> Optional
             'cloud_cover': w.get('cloudCover'),
             'feels_like_temperature': (w.get('feelsLikeTemperature', {}) or {}).get('degrees')
         }
+        # Descartar entradas vencidas para que el caché no crezca sin límite
+        for key in [k for k, (ts, _) in _weather_cache.items() if now - ts >= WEATHER_CACHE_TTL]:
+            del _weather_cache[key]
+        _weather_cache[cache_key] = (now, result)
         return result
     except Exception as e:
         print(f"⚠️  Error Weather API: {e}")
         return None
 
 
+def distance_m(a, b) -> float:
+    """Distancia aproximada en metros entre dos pares (lat, lng) (fórmula de haversine)."""
+    lat1, lng1 = map(math.radians, a)
+    lat2, lng2 = map(math.radians, b)
+    h = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * 6371000 * math.asin(math.sqrt(h))
+
+
+def coords_moved(previous, current) -> bool:
+    """Indica si la posición cambió lo suficiente para volver a consultar la Weather API."""
+    if None in current:
+        return False
+    if None in previous:
+        return True
+    return distance_m(previous, current) > WEATHER_REFETCH_DISTANCE_M
+
+
 def get_total_records():
     """Obtiene el número total de registros en la base de datos"""
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM weather_readings")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    with borrow() as conn:
+        return conn.execute(SQL_COUNT_ALL).fetchone()[0]
 
 
 def main():
@@ -495,33 +351,47 @@ def main():
     print("Presiona Ctrl+C para detener")
     print("-" * 60)
 
+    # Firebase y Weather API se consultan en paralelo: la Weather API usa las
+    # últimas coordenadas conocidas mientras llega la lectura de Firebase
+    executor = ThreadPoolExecutor(max_workers=2)
+    last_coords = (None, None)
+    next_tick = time.monotonic()
+
     try:
         while True:
-            # Obtener datos de Firebase
-            firebase_data = get_firebase_data()
+            firebase_future = executor.submit(get_firebase_data)
+            weather_future = executor.submit(get_weather_api_data, *last_coords)
+            firebase_data = firebase_future.result()
+            weather_extra = weather_future.result()
 
             if firebase_data:
-                # Obtener último registro de SQLite
-                last_reading = get_last_reading()
-
-                # Enriquecer con Weather API si hay coordenadas
-                weather_extra = get_weather_api_data(
-                    firebase_data.get(
-                        'latitude'), firebase_data.get('longitude')
-                )
+                # Repetir la consulta meteorológica si el dron se desplazó
+                coords = (firebase_data.get('latitude'),
+                          firebase_data.get('longitude'))
+                if None in coords:
+                    # Sin posición actual no se asocian datos de una ubicación previa
+                    weather_extra = None
+                elif coords_moved(last_coords, coords):
+                    weather_extra = get_weather_api_data(*coords)
+                    last_coords = coords
                 if weather_extra:
                     firebase_data.update(weather_extra)
 
                 # Verificar si es un registro nuevo
-                if is_new_reading(firebase_data, last_reading):
+                if is_new_reading(firebase_data):
                     save_to_sqlite(firebase_data)
                     total = get_total_records()
                     print(f"   📈 Total de registros en base de datos: {total}")
                 else:
                     print("⏭️  Sin cambios - registro ignorado")
 
-            # Esperar antes de la próxima consulta
-            time.sleep(QUERY_INTERVAL)
+            # Esperar hasta la próxima consulta descontando el tiempo de trabajo;
+            # si el ciclo se retrasó más de un intervalo, reprogramar sin ponerse al día
+            next_tick += QUERY_INTERVAL
+            now = time.monotonic()
+            if now - next_tick > QUERY_INTERVAL:
+                next_tick = now + QUERY_INTERVAL
+            time.sleep(max(0, next_tick - now))
 
     except KeyboardInterrupt:
         print()
@@ -530,6 +400,8 @@ def main():
         total = get_total_records()
         print(f"📊 Total de registros guardados: {total}")
         print("=" * 60)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":